@@ -7,27 +7,38 @@
 Author: Jody Foo, February 2023.
 """
 import argparse
+import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from shutil import copytree
+from shutil import copy2, copytree
 
 # Default globals
 INDENT = '\t'
+# four spaces per initial tab, indexed by number of tabs
+TAB_SPACES = tuple('    ' * i for i in range(64))
 
 # Compiled regular expressions
 heading_re = re.compile(r"(#+) ")
-tab_indents_re = re.compile(r"(\t+)")
-inline_code_re = re.compile(r"`.*?`")
-indent_level_re = re.compile(r"(    )+")
+# title: line in frontmatter, i.e. before the line starting with '---' that
+# ends the frontmatter
+title_re = re.compile(r"---.*\n(?:(?!---|title:).*\n)*title:(.*)")
 bullet_re = re.compile(r"^( *)([-*+])(.*)")
-embed_token_re = re.compile(r"!\[\[.+?\]\]")
-embed_token_with_anchor_re = re.compile(r"!\[\[(.+?)(#.*)?\]\]")
-wiki_link_token_re = re.compile(r"\[\[.+?\]\]")
-wiki_link_token_with_alias_re = re.compile(r"\[\[([^\[]+?)\|([^#].+?)(?:#.*?)?\]\]")
-wiki_link_token_with_internals_re = re.compile(r"\[\[(.*?\|)?(.+?)(#.*)?\]\]")
+# inline code, or an embed/wikilink token with the link target in group 3
+token_re = re.compile(r"(`.*?`)|(!?)\[\[([^`]+?)\]\]")
 image_assets_re = re.compile(r"(!\[.*?\]\()(/assets/)(.*?\))")
 
+# Block context states used when processing the document body
+S_NONE = 0
+S_HEADING = 1
+S_LIST = 2
+S_PARAGRAPH = 3
+S_FENCED = 4
+S_INDENTED = 5
+S_BLOCKQUOTE = 6
+
 
 def ask_for_confirmation(msg, default=None):
     """Promt msg to user, return answer: 'y' (True), 'n' (False).
@@ -50,12 +61,19 @@ def get_duplicate_titles(vault_path):
     """Return any duplicate titles, {title: [filepath, filepath], ...}."""
     # {title: [filepath1, filpath2, ...], ...}
     titles = {}
-    # collect titles
-    for childpath in vault_path.iterdir():
-        if childpath.is_file() and childpath.suffix == '.md':
-            title = get_title(childpath)
+    # collect markdown files, DirEntry caches file type -> no extra stat calls
+    with os.scandir(vault_path) as entries:
+        md_entries = [entry for entry in entries
+                      if entry.is_file()
+                      and os.path.splitext(entry.name)[1] == '.md']
+
+    # collect titles, reading files is I/O bound -> overlap reads in threads
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        md_titles = executor.map(get_title,
+                                 [entry.path for entry in md_entries])
+        for entry, title in zip(md_entries, md_titles):
             if title:
-                titles.setdefault(title, []).append(childpath.name)
+                titles.setdefault(title, []).append(entry.name)
 
     # collect duplicate titles
     duplicates = {}
@@ -67,542 +85,566 @@ def get_duplicate_titles(vault_path):
 
 def get_title(md_filepath):
     """Return title of markdown file at md_filepath. Return None if not found."""
-    title = None
     with open(md_filepath, encoding="utf-8") as md_file:
-        for line_num, line in enumerate(md_file):
-            # first line - no frontmatter?
-            if line_num == 0:
-                if not line.startswith('---'):
-                    break
-                continue
-            # frontmatter - title found
-            elif line.startswith('title:'):
-                title = line[6:].strip()
-                # strip initial and ending quotes
-                if title[0] in ['"', "'"] and title[-1] == title[0]:
-                    title = title[1:-1]
-                    break
-            # end of frontmatter
-            elif line.rstrip().startswith('---'):
-                break
+        # the title is in the frontmatter at the top of the file, only read
+        # the rest of the file if the end of the frontmatter was not found
+        text = md_file.read(4096)
+        if text.startswith('---') and '\n---' not in text:
+            text += md_file.read()
+    match = title_re.match(text)
+    if not match:
+        return None
+    title = match[1].strip()
+    # strip initial and ending quotes
+    if title[:1] in ['"', "'"] and title[-1] == title[0]:
+        title = title[1:-1]
     return title
 
 
 def get_indent_level(line):
-    m = indent_level_re.match(line)
-    if m:
-        return len(m[0]) // 4
-    return 0
+    """Return number of initial four space indents in line."""
+    return (len(line) - len(line.lstrip(' '))) // 4
 
 
-def push_to_stack_no_repeat(stack, value):
-    if not stack or stack[-1] != value:
-        stack.append(value)
+def copy_asset(src, dst, link=False):
+    """Copy src to dst, or hard link it if link is True.
+
+    Used as copy_function for copytree(). If dst already is src (hard linked
+    by an earlier run) nothing is done. When linking, an existing different
+    dst is replaced atomically, and src is copied if it can't be linked, e.g.
+    if src and dst are on different filesystems.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return dst
+    if not link:
+        return copy2(src, dst)
+    # link to a temporary name next to dst, then replace dst with it
+    dst_dir, dst_name = os.path.split(dst)
+    tmp_path = os.path.join(dst_dir, f".{dst_name}.{os.getpid()}.tmp")
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        return copy2(src, dst)
+    try:
+        os.replace(tmp_path, dst)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    return dst
+
+
+def _process_one(job):
+    """Process one markdown file, job is a tuple of process_and_save_file args.
+
+    Top-level function so that it can be pickled and run in a worker process.
+    Returns the message to print, printing is done by the main process to keep
+    the output in order. Errors are re-raised with the name of the note, since
+    the message for a failing note is never printed.
+    """
+    source_path, new_name = job[0], job[2]
+    try:
+        process_and_save_file(*job)
+    except Exception as exc:
+        raise RuntimeError(f"Failed to convert {source_path.name}") from exc
+    return f"{source_path.name} -> {new_name}"
 
 
 def vault2graph(vault_path, output_path, remove_frontmatter, alias_title,
-                use_title, remove_empty_lines):
+                use_title, remove_empty_lines, indent=INDENT,
+                link_assets=False):
     """Save assets dir and processed markdown files to output_path."""
     print(f"\nProcessing Dendron vault at {vault_path.resolve()}")
     msg = "Options: {rm_fm}, {alias}, {title}, {rm_lines}\n"
     print(msg.format(rm_fm=f"{remove_frontmatter=}", alias=f"{alias_title=}",
                      title=f"{use_title=}", rm_lines=f"{remove_empty_lines=}"))
 
-    # process directory items
+    # process directory items, markdown files are collected as jobs
     assets_path = None
-    for childpath in vault_path.iterdir():
-        if childpath.name[0] == "." or childpath.suffix == ".yml":
-            print(f"IGNORED: {childpath.name}")
-            continue
-        elif childpath.is_dir() and childpath.name == "assets":
-            assets_path = childpath
-        elif childpath.suffix == ".md":
-            new_name = f"{childpath.stem.replace('.', '___')}.md"
-            print(f"{childpath.name} -> {new_name}")
-            process_and_save_file(childpath, output_path, new_name,
-                                  remove_frontmatter, alias_title, use_title,
-                                  remove_empty_lines)
-        else:
-            print(f"WARNING: File not handled, {childpath.name!r}")
+    jobs = []
+    with os.scandir(vault_path) as entries:
+        for entry in entries:
+            stem, suffix = os.path.splitext(entry.name)
+            if entry.name[0] == "." or suffix == ".yml":
+                print(f"IGNORED: {entry.name}")
+                continue
+            elif entry.name == "assets" and entry.is_dir():
+                assets_path = Path(entry.path)
+            elif suffix == ".md":
+                new_name = f"{stem.replace('.', '___')}.md"
+                jobs.append((Path(entry.path), output_path, new_name,
+                             remove_frontmatter, alias_title, use_title,
+                             remove_empty_lines, indent))
+            else:
+                print(f"WARNING: File not handled, {entry.name!r}")
+
+    # files are independent of each other -> process them in parallel
+    # the indent sequence is part of the job since worker processes do not
+    # necessarily inherit globals set in __main__
+    with ProcessPoolExecutor() as executor:
+        for msg in executor.map(_process_one, jobs, chunksize=8):
+            print(msg)
 
     if assets_path:
-        msg = "Assets directory found, copying {src} -> {dest}"
-        print(msg.format(src=assets_path.resolve(),
+        msg = "Assets directory found, {action} {src} -> {dest}"
+        print(msg.format(action="linking" if link_assets else "copying",
+              src=assets_path.resolve(),
               dest=(output_path / 'assets').resolve()))
-        copytree(assets_path, output_path / "assets", dirs_exist_ok=True)
+        # hard links avoid copying the contents of large asset files
+        copytree(assets_path, output_path / "assets", dirs_exist_ok=True,
+                 copy_function=partial(copy_asset, link=link_assets))
 
 
 def process_and_save_file(source_path, output_path, new_name,
                           remove_frontmatter, alias_title, use_title,
-                          remove_empty_lines):
+                          remove_empty_lines, indent=INDENT):
     output = []
+    append = output.append
+    # alias::/title:: property, written before output
+    header_prefix = ''
     with open(source_path, 'r', encoding="utf-8") as source_file:
-        first_line_checked = False
-        in_frontmatter = False
-        in_body = False
-        frontmatter_handled = False
-        heading_level = 0
-        indent_level = 0
-        content_stack = []
-        previous_line = None
-
-        for line in source_file:
-            # first line, check if frontmatter exists
-            if not first_line_checked:
-                if not line.rstrip().startswith('---'):
+        # read all lines at once, no I/O in the processing loop
+        lines = source_file.readlines()
+
+    in_frontmatter = False
+    in_body = False
+    # first line, check if frontmatter exists
+    frontmatter_handled = not (lines and lines[0].startswith('---'))
+    heading_level = 0
+    # indent prefixes for the current heading level, only change on headings
+    prefix = ''
+    prefix_bullet = '- '
+    prefix_cont = '  '
+    indent_level = 0
+    top_state = S_NONE
+    in_list = False
+    pre_fence_state = S_NONE
+    previous_line = None
+
+    for line in lines:
+        #### PROCESS FRONTMATTER ####
+        if not frontmatter_handled:
+            #print(f"FRONTMATTER: {line!r}")
+            # start/end of frontmatter found
+            if line.startswith('---'):
+                # start
+                if not in_frontmatter:
+                    in_frontmatter = True
+                    # keep frontmatter - begin code block
+                    if not remove_frontmatter:
+                        # frontmatter will be added as a code block
+                        append('- ```\n')
+                        append("  " + line)
+                # end
+                else:
+                    # keep frontmatter - end code block
+                    if not remove_frontmatter:
+                        append("  " + line)
+                        append('  ```\n')
+                    in_frontmatter = False
                     frontmatter_handled = True
-                first_line_checked = True
-
-            #### PROCESS FRONTMATTER ####
-            if not frontmatter_handled:
-                #print(f"FRONTMATTER: {line!r}")
-                # start/end of frontmatter found
-                if line.rstrip().startswith('---'):
-                    # start
-                    if not in_frontmatter:
-                        in_frontmatter = True
-                        # keep frontmatter - begin code block
-                        if not remove_frontmatter:
-                            # frontmatter will be added as a code block
-                            output.append('- ```\n')
-                            output.append(f"  {line}")
-                    # end
-                    else:
-                        # keep frontmatter - end code block
-                        if not remove_frontmatter:
-                            output.append(f"  {line}")
-                            output.append('  ```\n')
-                        in_frontmatter = False
-                        frontmatter_handled = True
-                    # start/end handled, go to next line
-                    continue
+                # start/end handled, go to next line
+                continue
 
-                # frontmatter not handled, line is not '---' -> in frontmatter
-                # use title as alias?
-                elif line.startswith('title:'):
-                    if alias_title:
-                        output.insert(0, f"alias:: {line[6:].lstrip()}")
-                    elif use_title:
-                        output.insert(0, f"title:: {line[6:].lstrip()}")
-                    elif not remove_frontmatter:
-                        output.append(f"  {line}")
-                # add key to code block
+            # frontmatter not handled, line is not '---' -> in frontmatter
+            # use title as alias?
+            elif line.startswith('title:'):
+                if alias_title:
+                    header_prefix = f"alias:: {line[6:].lstrip()}{header_prefix}"
+                elif use_title:
+                    header_prefix = f"title:: {line[6:].lstrip()}{header_prefix}"
                 elif not remove_frontmatter:
-                    output.append(f"  {line}")
+                    append("  " + line)
+            # add key to code block
+            elif not remove_frontmatter:
+                append("  " + line)
 
-                # next line (no need for else below)
-                continue
+            # next line (no need for else below)
+            continue
 
-            # keep unprocessed line (except for \t replacement) to save as
-            # previous_line
-            unprocessed_line = line
+        # keep unprocessed line (except for \t replacement) to save as
+        # previous_line
+        unprocessed_line = line
+        # line without indentation and its first character ('' if the line
+        # is empty), same before and after \t replacement
+        stripped = line.lstrip()
+        first = stripped[:1]
 
-            #### BETWEEN FRONTMATTER AND BODY ####
+        #### BETWEEN FRONTMATTER AND BODY ####
 
-            if not in_body:
-                if line.strip() == '':
-                    previous_line = unprocessed_line
-                    if remove_empty_lines in ['all', 'trim']:
-                        continue
-                    elif remove_empty_lines == 'none':
-                        output.append("-\n")
-                else:
-                    in_body = True
-
-            #### PROCESS DOCUMENT BODY ####
-            #print(f"BODY: {line!r}")
-
-            # content_stack is used to keep track of the current block context
-            # content_stack is [] in the beginning
-            #
-            # possible items on the stack:
-            #  - "fenced code block"
-            #  - "indented code block"
-            #  - "heading"
-            #  - "ul" (unordered list)
-            #  - "paragraph"
-            #
-            # changes to content_stack
-            #   - an empty line clears the stack unless the top item is
-            #     "heading"
-            #   - headings clears the stack
-            #   - indented code blocks are only valid outside if the stack is
-            #     empty or if directly after "heading"
-            #   - fenced code blocks are valid everywhere
-            #   - list clears content stack if the current top item is not
-            #     "list"
-            #   - if top of stack is heading and any content is encountered,
-            #     stack is cleared
-            #
-
-            # replace initial tabs with four spaces
-            if line[0] == '\t':
-                match = tab_indents_re.match(line)
-                if match:
-                    num_tabs = len(match[1])
-                    line = f"{'    '*num_tabs}{line[num_tabs:]}"
-
-            ######## CODE BLOCKS ########
-
-            # ``` code block start/end
-            # LIMITATION: Does not handle indented code blocks (in outline).
-            # Will remove any indentation before '```'
-            if line.lstrip().startswith("```"):
-                #print(f"```: {line=}, {content_stack=}")
-                #print(f"CODE: {line!r}")
-                #line = line.lstrip()
-                # start
-                if content_stack[-1:] != ["fenced code block"]:
-                    # fenced code block clears stack if added after heading
-                    if content_stack[-1:] == ["heading"]:
-                        indent_level = 0
-                        content_stack.clear()
-
-                    # start of code block part of list
-                    if 'list' in content_stack:
-                        block_indent = get_indent_level(line)
-                        # start at same or greater indent level -> part of same
-                        # list item
-                        if block_indent >= indent_level:
-                            # assume indent is correct
-                            line = f"{INDENT*heading_level}{line}"
-                        # outdented level -> new fenced code block in list
-                        else:
-                            indent_level = block_indent
-                            line = f"{INDENT*heading_level}{INDENT*block_indent}- {line.lstrip()}"
-                    # start of code block outside list
+        if not in_body:
+            if not first:
+                previous_line = unprocessed_line
+                if remove_empty_lines in ['all', 'trim']:
+                    continue
+                elif remove_empty_lines == 'none':
+                    append("-\n")
+            else:
+                in_body = True
+
+        #### PROCESS DOCUMENT BODY ####
+        #print(f"BODY: {line!r}")
+
+        # top_state is used to keep track of the current block context,
+        # in_list is True if the current block is part of a list
+        # top_state is S_NONE in the beginning
+        #
+        # possible states:
+        #  - S_FENCED (fenced code block)
+        #  - S_INDENTED (indented code block)
+        #  - S_HEADING
+        #  - S_LIST (unordered list)
+        #  - S_PARAGRAPH
+        #  - S_BLOCKQUOTE
+        #
+        # changes to the block context
+        #   - an empty line clears the context (S_NONE, not in list)
+        #     unless top_state is S_HEADING
+        #   - headings clears the context
+        #   - indented code blocks are only valid if top_state is S_NONE
+        #     or S_HEADING
+        #   - fenced code blocks are valid everywhere, the state before
+        #     the fenced code block is restored at the end of the block
+        #   - if top_state is S_HEADING and any content is encountered,
+        #     the context is cleared
+        #
+
+        # replace initial tabs with four spaces
+        if line[0] == '\t':
+            num_tabs = len(line) - len(line.lstrip('\t'))
+            if num_tabs < len(TAB_SPACES):
+                line = TAB_SPACES[num_tabs] + line[num_tabs:]
+            else:
+                line = '    ' * num_tabs + line[num_tabs:]
+
+        ######## CODE BLOCKS ########
+
+        # ``` code block start/end
+        # LIMITATION: Does not handle indented code blocks (in outline).
+        # Will remove any indentation before '```'
+        if first == '`' and stripped.startswith("```"):
+            #print(f"```: {line=}, {top_state=}")
+            #print(f"CODE: {line!r}")
+            #line = line.lstrip()
+            # start
+            if top_state != S_FENCED:
+                # fenced code block clears context if added after heading
+                if top_state == S_HEADING:
+                    indent_level = 0
+                    top_state = S_NONE
+                    in_list = False
+
+                # start of code block part of list
+                if in_list:
+                    block_indent = get_indent_level(line)
+                    # start at same or greater indent level -> part of same
+                    # list item
+                    if block_indent >= indent_level:
+                        # assume indent is correct
+                        line = prefix + line
+                    # outdented level -> new fenced code block in list
                     else:
-                        # fenced code block is part of paragraph, align with
-                        # paragraph bullet
-                        if content_stack[-1:] == ['paragraph']:
-                            line = f"{INDENT*heading_level}  {line}"
-                        # fenced code block is not in list or part of paragraph
-                        # -> new bullet
-                        else:
-                            # clears content_stack
-                            indent_level = 0
-                            content_stack.clear()
-                            line = f"{INDENT*heading_level}- {line}"
-                    push_to_stack_no_repeat(content_stack, "fenced code block")
-                # end
+                        indent_level = block_indent
+                        line = f"{prefix}{indent*block_indent}- {stripped}"
+                # start of code block outside list
                 else:
-                    # code block part of list, assume indent good
-                    if 'list' in content_stack:
-                        line = f"{INDENT*heading_level}{line}"
-                    # otherwise align with paragraph bullet
+                    # fenced code block is part of paragraph, align with
+                    # paragraph bullet
+                    if top_state == S_PARAGRAPH:
+                        line = prefix_cont + line
+                    # fenced code block is not in list or part of paragraph
+                    # -> new bullet
                     else:
-                        line = f"{INDENT*heading_level}  {line}"
-                    content_stack.pop()
-                output.append(line)
-                previous_line = unprocessed_line
-                continue
-
-            # In fenced code block, do not change line, just indent
-            # assume line is originally correctly indented
-            if content_stack[-1:] == ["fenced code block"]:
-                #print(f"CODE: {line!r}")
+                        # clears context
+                        indent_level = 0
+                        top_state = S_NONE
+                        in_list = False
+                        line = prefix_bullet + line
+                pre_fence_state = top_state
+                top_state = S_FENCED
+            # end
+            else:
                 # code block part of list, assume indent good
-                if 'list' in content_stack:
-                    line = f"{INDENT*heading_level}{line}"
+                if in_list:
+                    line = prefix + line
                 # otherwise align with paragraph bullet
                 else:
-                    line = f"{INDENT*heading_level}  {line}"
-                output.append(line)
-                previous_line = unprocessed_line
-                continue
-
-            # possible indented code block starts with '    '
-            if line.startswith('    '):
-                # start of indented code block?
-                # only start if content_stack is empty or after heading and
-                # not already in indented code block
-                #print(f"{line=}, {content_stack=}")
-                if ((not content_stack or content_stack[-1:] == ["heading"])
-                        and content_stack[-1:] != ["indented code block"]):
-                    #print("START OF INDENTED CODE BLOCK")
-                    # indented code block clears stack if added after heading
-                    if content_stack[-1:] == ["heading"]:
-                        indent_level = 0
-                        content_stack.clear()
-                    output.append(f"{INDENT*heading_level}- ```\n")
-                    push_to_stack_no_repeat(content_stack, "indented code block")
-
-                # in indented code block
-                if content_stack[-1:] == ["indented code block"]:
-                    # add code line to code block
-                    line = f"{INDENT*heading_level}  {line[4:]}"
-                    output.append(line)
-                    previous_line = unprocessed_line
-                    continue
-            # end of indented code block
-            elif content_stack[-1:] == ["indented code block"]:
-                # add ending ```
-                output.append(f"{INDENT*heading_level}  ```\n")
-                # no longer in indented code block
-                content_stack.pop()
-
-            ######## NON-CODE BLOCKS ########
-            # Outside of code block and frontmatter
-
-            # Handle empty lines: keep all, remove all, trim
-            if line.strip() == '':
-                #print(f"EMPTY LINE a: {previous_line=}, {content_stack=}")
-                # empty line clears stack if top of stack is not "heading"
-                if content_stack[-1:] != ["heading"]:
-                    indent_level = 0
-                    content_stack.clear()
-                #print(f"EMPTY LINE b: {previous_line=}, {content_stack=}")
-
-                # keep empty lines
-                if remove_empty_lines == 'none':
-                    line = f"{INDENT*heading_level}- {line}"
-                    output.append(line)
-                # remove all empty lines
-                elif remove_empty_lines == 'all':
-                    pass
-                # trim empty lines
-                elif remove_empty_lines == 'trim':
-                    #print(f"TRIM: {previous_line=}, {content_stack=}")
-                    # remove empty lines after headings
-                    if content_stack[-1:] == ["heading"]:
-                        pass
-                    # keep one empty line
-                    elif previous_line.strip() != '':
-                        line = f"{INDENT*heading_level}- {line}"
-                        output.append(line)
-                previous_line = unprocessed_line
-                continue
+                    line = prefix_cont + line
+                top_state = pre_fence_state
+            append(line)
+            previous_line = unprocessed_line
+            continue
 
-            ######## NON-EMPTY, NON-CODE BLOCK LINES ########
+        # In fenced code block, do not change line, just indent
+        # assume line is originally correctly indented
+        if top_state == S_FENCED:
+            #print(f"CODE: {line!r}")
+            # code block part of list, assume indent good
+            if in_list:
+                line = prefix + line
+            # otherwise align with paragraph bullet
+            else:
+                line = prefix_cont + line
+            append(line)
+            previous_line = unprocessed_line
+            continue
 
-            # horizontal rules
-            if line.strip() in ['---', '***']:
-                line = f"{INDENT*heading_level}- {line.lstrip()}"
-                output.append(line)
+        # possible indented code block starts with '    '
+        if line.startswith('    '):
+            # start of indented code block?
+            # only start if there is no block context or after heading
+            # (i.e. not already in indented code block)
+            #print(f"{line=}, {top_state=}")
+            if top_state == S_NONE or top_state == S_HEADING:
+                #print("START OF INDENTED CODE BLOCK")
+                # indented code block clears context if added after heading
+                if top_state == S_HEADING:
+                    indent_level = 0
+                    in_list = False
+                append(prefix_bullet + "```\n")
+                top_state = S_INDENTED
+
+            # in indented code block
+            if top_state == S_INDENTED:
+                # add code line to code block
+                line = prefix_cont + line[4:]
+                append(line)
                 previous_line = unprocessed_line
                 continue
+        # end of indented code block
+        elif top_state == S_INDENTED:
+            # add ending ```
+            append(prefix_cont + "```\n")
+            # no longer in indented code block, indented code blocks are
+            # only started without block context
+            top_state = S_NONE
+
+        ######## NON-CODE BLOCKS ########
+        # Outside of code block and frontmatter
+
+        # Handle empty lines: keep all, remove all, trim
+        if not first:
+            #print(f"EMPTY LINE a: {previous_line=}, {top_state=}")
+            # empty line clears context if top_state is not S_HEADING
+            if top_state != S_HEADING:
+                indent_level = 0
+                top_state = S_NONE
+                in_list = False
+            #print(f"EMPTY LINE b: {previous_line=}, {top_state=}")
+
+            # keep empty lines
+            if remove_empty_lines == 'none':
+                line = prefix_bullet + line
+                append(line)
+            # remove all empty lines
+            elif remove_empty_lines == 'all':
+                pass
+            # trim empty lines
+            elif remove_empty_lines == 'trim':
+                #print(f"TRIM: {previous_line=}, {top_state=}")
+                # remove empty lines after headings
+                if top_state == S_HEADING:
+                    pass
+                # keep one empty line
+                elif previous_line.strip() != '':
+                    line = prefix_bullet + line
+                    append(line)
+            previous_line = unprocessed_line
+            continue
 
-            # Headings - Use headings to determine outline hierarchy
-            if line[0] == '#':
-                #print(f"HEADING: {line!r}")
-                match = heading_re.match(line)
-                if match:
-                    heading_level = len(match[1])
+        ######## NON-EMPTY, NON-CODE BLOCK LINES ########
 
-                    # heading clears content_stack
-                    indent_level = 0
-                    content_stack.clear()
-
-                    # indent heading
-                    line = f"{INDENT*(heading_level-1)}- {line}"
-                    line = convert_internal_links(line)
-                    output.append(line)
-                    push_to_stack_no_repeat(content_stack, "heading")
-                    previous_line = unprocessed_line
-                    continue
+        # horizontal rules
+        if (first == '-' or first == '*') and stripped.rstrip() in ('---', '***'):
+            line = prefix_bullet + stripped
+            append(line)
+            previous_line = unprocessed_line
+            continue
 
-            # Blockquotes
-            if line.lstrip()[0] == '>':
-                #print(f">: {line=}, {block_indent=}, {indent_level=}, {content_stack=}")
-                # block quotes in lists
-                if 'list' in content_stack:
-                    block_indent = get_indent_level(line)
-                    # same or greater indent level -> part of same list item
-                    if block_indent >= indent_level:
-                        # assume indent is correct
-                        line = f"{INDENT*heading_level}{line}"
-                    # outdented level -> new blockquote block in list
-                    else:
-                        indent_level = block_indent
-                        line = f"{INDENT*heading_level}{INDENT*block_indent}- {line.lstrip()}"
-                # outside list
-                else:
-                    # continuation of block quote outside list
-                    if content_stack[-1:] == ['blockquote']:
-                        line = f"{INDENT*heading_level}  {line}"
-                    # new blockquote outside list
-                    else:
-                        # resets content_stack
-                        indent_level = 0
-                        content_stack.clear()
-                        line = f"{INDENT*heading_level}- {line}"
+        # Headings - Use headings to determine outline hierarchy
+        if line[0] == '#':
+            #print(f"HEADING: {line!r}")
+            match = heading_re.match(line)
+            if match:
+                heading_level = len(match[1])
+                prefix = indent * heading_level
+                prefix_bullet = prefix + '- '
+                prefix_cont = prefix + '  '
+
+                # heading clears context
+                indent_level = 0
+                in_list = False
+
+                # indent heading
+                line = f"{indent*(heading_level-1)}- {line}"
                 line = convert_internal_links(line)
-                output.append(line)
-                push_to_stack_no_repeat(content_stack, 'blockquote')
+                append(line)
+                top_state = S_HEADING
                 previous_line = unprocessed_line
                 continue
 
-            ############ BULLET OR PARAGRAPH ############
+        # Blockquotes
+        if first == '>':
+            #print(f">: {line=}, {block_indent=}, {indent_level=}, {top_state=}")
+            # block quotes in lists
+            if in_list:
+                block_indent = get_indent_level(line)
+                # same or greater indent level -> part of same list item
+                if block_indent >= indent_level:
+                    # assume indent is correct
+                    line = prefix + line
+                # outdented level -> new blockquote block in list
+                else:
+                    indent_level = block_indent
+                    line = f"{prefix}{indent*block_indent}- {stripped}"
+            # outside list
+            else:
+                # continuation of block quote outside list
+                if top_state == S_BLOCKQUOTE:
+                    line = prefix_cont + line
+                # new blockquote outside list
+                else:
+                    # resets context
+                    indent_level = 0
+                    line = prefix_bullet + line
+            line = convert_internal_links(line)
+            append(line)
+            top_state = S_BLOCKQUOTE
+            previous_line = unprocessed_line
+            continue
+
+        ############ BULLET OR PARAGRAPH ############
 
-            # bullets (unordered list)
-            if line.lstrip()[:2] in ['- ', '* ', '+ ']:
-                # new bullet -> new indent_level
-                indent_level = get_indent_level(line)
+        # bullets (unordered list)
+        if stripped[:2] in ('- ', '* ', '+ '):
+            # new bullet -> new indent_level
+            indent_level = get_indent_level(line)
 
-                # normalize bullet to '- '
+            # normalize bullet to '- ', nothing to do for '- ' bullets
+            if first != '-':
                 line = bullet_re.sub(r"\1-\3", line)
-                line = f"{INDENT*heading_level}{line}"
+            line = prefix + line
 
-                # push context
-                push_to_stack_no_repeat(content_stack, "list")
+            # list context
+            top_state = S_LIST
+            in_list = True
 
-            # line without block prefix {-, >}
+        # line without block prefix {-, >}
+        else:
+            block_indent = get_indent_level(line)
+
+            # no linebreak, and same indent level -> line belongs to the
+            # previous paragraph/bullet/blockquote
+            if (previous_line and previous_line.strip() != ''
+                    and block_indent >= indent_level):
+                line = prefix_cont + line
+            # new paragraph
             else:
-                block_indent = get_indent_level(line)
+                # clears context
+                indent_level = 0
+                in_list = False
+                line = prefix_bullet + line
+                top_state = S_PARAGRAPH
 
-                # no linebreak, and same indent level -> line belongs to the
-                # previous paragraph/bullet/blockquote
-                if (previous_line and previous_line.strip() != ''
-                        and block_indent >= indent_level):
-                    line = f"{INDENT*heading_level}  {line}"
-                # new paragraph
-                else:
-                    # clears content_stack
-                    indent_level = 0
-                    content_stack.clear()
-                    line = f"{INDENT*heading_level}- {line}"
-                    push_to_stack_no_repeat(content_stack, "paragraph")
+        #print(f"OUTLINE: {line!r}")
 
-            #print(f"OUTLINE: {line!r}")
+        ############ CONVERT EMBEDS AND INTERNAL LINKS ############
 
-            ############ CONVERT EMBEDS AND INTERNAL LINKS ############
+        # embeds, ![[title]], and internal links, [[title]], are converted
+        # in a single pass so that an embed is never mistaken for an
+        # internal link
+        line = convert_embeds_and_links(line)
 
-            # take care of embeds, ![[title]] before internal links, [[title]]
-            # so that we don't have to worry about accidentally mistaking an
-            # embed for a internal link
-            line = convert_embeds(line)
-            line = convert_internal_links(line)
+        # fix image path from /assets/ to ./assets/
+        if '](/assets/' in line:
+            #print(f"before: {line}")
+            line = image_assets_re.sub(r"\1../assets/\3", line)
+            #print(f"after: {line}")
 
-            # fix image path from /assets/ to ./assets/
-            if 'assets' in line:
-                #print(f"before: {line}")
-                line = image_assets_re.sub(r"\1../assets/\3", line)
-                #print(f"after: {line}")
+        append(line)
+        previous_line = unprocessed_line
+        #print(f"{previous_line=}")
 
-            output.append(line)
-            previous_line = unprocessed_line
-            #print(f"{previous_line=}")
+    # write output
+    #pprint(output)
+    (output_path / new_name).write_text(header_prefix + "".join(output),
+                                        encoding="utf-8")
 
-        # write output
-        #pprint(output)
-        with open(output_path / new_name, 'w', encoding="utf-8") as output_file:
-            output_file.write("".join(output))
 
+def convert_embeds_and_links(line):
+    """Convert embeds and internal links, inline code is left as it is.
 
-def convert_embeds(line):
-    """Convert embeds, ![[a.b.note-name]] -> {{embed [[a/b/note-name]]}}.
+    Embeds, ![[a.b.note-name]] -> {{embed [[a/b/note-name]]}}. Anchors are
+    removed, i.e. both ![[note#^ref]] and ![[note#start:#end]] are changed to
+    {{embed [[note]]}}
 
-    Anchors are removed, i.e. both ![[note#^ref]] and ![[note#start:#end]] are
-    changed to {{embed [[note]]}}
+    Internal links are converted by convert_link_target().
     """
-    #print(f"convert embeds: {line!r}")
-    # line is split into splits (with possible embeds to be converted)
-    # by inline code separators (to be kept as they are)
-    non_code_splits = inline_code_re.split(line)  # parts not in ``
-    code_separators = inline_code_re.findall(line)
-
-    #print(f"{non_code_splits=}, {code_separators=}")
-
-    # for each non_code_split, replace '.' -> '/' in embed tokens and replace
-    # dendron embed tokens with logseq embed tokens
-    nc_i = 0
-    while nc_i < len(non_code_splits):
-        #print(f"{non_code_splits[nc_i]=}")
-        # a non_code split (possibly containing an embed) is split into splits
-        # without embeds using embed token regex as separators.
-        # embed tokens (separators) should be modified: Replace . -> /
-        non_embed_splits = embed_token_re.split(non_code_splits[nc_i])
-        embed_token_separators = embed_token_re.findall(non_code_splits[nc_i])
-
-        # replace . -> / in embed tokens
-        embed_token_index = 0
-        while embed_token_index < len(embed_token_separators):
-            embed_token_separators[embed_token_index] = embed_token_separators[embed_token_index].replace('.', '/')
-            #print(f"{embed_token_separators[embed_token_index]=}")
-            embed_token_index += 1
-
-        # recombine non_embed_splits with embed_token_separators if needed
-        # and put back into the correct non_code_split
-        if len(non_embed_splits) > 1:
-            non_code_splits[nc_i] = recombine_splits_separators(non_embed_splits, embed_token_separators)
-
-        # replace the all dendron embed tokens in non_code_split with logseq
-        # embed tokens and remove any anchor (block reference)
-        non_code_splits[nc_i] = embed_token_with_anchor_re.sub(r"{{embed [[\1]]}}", non_code_splits[nc_i])
-        nc_i += 1
-
-    return recombine_splits_separators(non_code_splits, code_separators)
+    # most lines have no embeds or links, skip the regex
+    if '[[' not in line:
+        return line
+    return token_re.sub(_convert_embed_or_link_token, line)
 
 
 def convert_internal_links(line):
-    """Convert internal links, [[a.b.c.note-title]] -> [[a/b/c/note-title]]."""
-    # line is split into splits (with possible embeds to be converted)
-    # by inline code separators (to be kept as they are)
-    non_code_splits = inline_code_re.split(line)  # parts not in ``
-    code_separators = inline_code_re.findall(line)
-
-    #print(f"convert line: {non_code_splits=}, {code_separators=}")
-
-    # for each non_code_split, replace '.' -> '/' in link tokens and remove
-    # anchors from link tokens
-    nc_i = 0
-    while nc_i < len(non_code_splits):
-        #print(f"{non_code_splits[nc_i]=}")
-        # a non_code split (possibly containing a link) is split into splits
-        # without links using link token regex as separators.
-        # link tokens, the actual internal links (seen as separators of
-        # ordinary text) should be modified: Replace . -> /
-        non_link_splits = wiki_link_token_re.split(non_code_splits[nc_i])
-        link_token_separators = wiki_link_token_re.findall(non_code_splits[nc_i])
-
-        # replace . -> / in link tokens (the links)
-        link_token_index = 0
-        while link_token_index < len(link_token_separators):
-            link_token_separators[link_token_index] = link_token_separators[link_token_index].replace('.', '/')
-            #print(f"{link_token_separators[link_token_index]=}")
-            link_token_index += 1
-
-        # recombine non_link_splits with link_token_separators if needed
-        # and put back into the correct non_code_split
-        if len(non_link_splits) > 1:
-            non_code_splits[nc_i] = recombine_splits_separators(non_link_splits, link_token_separators)
-
-        # replace all the dendron link tokens (links) in non_code_split
-        #print(f"before: {non_code_splits[nc_i]=}")
-        if wiki_link_token_with_alias_re.search(non_code_splits[nc_i]):
-            # Replace wikilinks with aliases :
-            # * from [[alias|page]] to [alias]([[page]])
-            # * from [[alias|page#header]] to [alias]([[page]])
-            non_code_splits[nc_i] = wiki_link_token_with_alias_re.sub(r"[\1]([[\2]])", non_code_splits[nc_i])
-
-        # Replace wikilinks with link tokens that do not have anchors or aliases
-        non_code_splits[nc_i] = wiki_link_token_with_internals_re.sub(r"[[\2]]", non_code_splits[nc_i])
-        #print(f"after: {non_code_splits[nc_i]=}")
-        nc_i += 1
-
-    return recombine_splits_separators(non_code_splits, code_separators)
-
-
-    # line is split into splits (with possible internal links to be converted)
-    # by inline code separators (to be kept as they are)
-    converted_ilink_splits = inline_code_re.split(line)
-    code_separators = inline_code_re.findall(line)
-
-    return recombine_splits_separators(converted_ilink_splits, code_separators)
-
-
-def recombine_splits_separators(splits, separators):
-    #print(f"recombine: {splits=}, {separators=}")
-    # combine changed elements with unchanged elements if necessary
-    if len(splits) > 1:
-        recombined = []
-        for index, separator in enumerate(separators):
-            recombined.append(f"{splits[index]}")
-            recombined.append(f"{separator}")
-        recombined.append(f"{splits[index+1]}")
-        return ''.join(recombined)
-    else:
-        return splits[0]
+    """Convert internal links, [[a.b.c.note-title]] -> [[a/b/c/note-title]].
+
+    Embeds are not converted, only the link inside the embed.
+    """
+    # most lines have no links, skip the regex
+    if '[[' not in line:
+        return line
+    return token_re.sub(_convert_link_token, line)
+
+
+def _convert_embed_or_link_token(match):
+    code, embed, target = match.groups()
+    # inline code, keep as it is
+    if code:
+        return code
+    target = target.replace('.', '/')
+    if embed:
+        # remove anchor (block reference)
+        anchor_index = target.find('#', 1)
+        if anchor_index != -1:
+            target = target[:anchor_index]
+        return "{{embed " + convert_link_target(target) + "}}"
+    return convert_link_target(target)
+
+
+def _convert_link_token(match):
+    code, embed, target = match.groups()
+    # inline code, keep as it is
+    if code:
+        return code
+    return embed + convert_link_target(target.replace('.', '/'))
+
+
+def convert_link_target(target):
+    """Return Logseq link for wikilink target (the part inside [[]]).
+
+    Aliases and anchors are handled:
+    - alias|note-title -> [alias]([[note-title]])
+    - alias|note-title#heading -> [alias]([[note-title]])
+    - note-title#heading -> [[note-title]]
+    """
+    alias, separator, note = target.partition('|')
+    # Replace wikilinks with aliases
+    if (separator and alias and note and '[' not in alias
+            and note[0] != '#'):
+        return f"[{alias}]([[{remove_link_internals(note)}]])"
+    # Replace wikilinks that do not have anchors or aliases
+    return f"[[{remove_link_internals(target)}]]"
+
+
+def remove_link_internals(target):
+    """Remove any alias and anchor from wikilink target."""
+    alias, separator, note = target.partition('|')
+    if separator and note:
+        target = note
+    anchor_index = target.find('#', 1)
+    if anchor_index != -1:
+        target = target[:anchor_index]
+    return target
 
 
 if __name__ == "__main__":
@@ -622,6 +664,9 @@ if __name__ == "__main__":
     parser.add_argument('--four-space-indent',
                         help="Indent using four spaces. Default: tab",
                         action='store_true')
+    parser.add_argument('--link-assets',
+                        help="Hard link files in the assets directory instead of copying them. Files are copied if they can't be linked, e.g. across filesystems.",
+                        action='store_true')
     parser.add_argument('--remove-empty-lines',
                         help="Remove empty lines. none: Don't remove any empty lines, all: Remove all empty lines, trim: Remove empty lines after headings and in beginning, keep maximum of one empty line in rest of document. Default: trim",
                         choices=['none', 'all', 'trim'],
@@ -632,8 +677,7 @@ if __name__ == "__main__":
     print(args)
 
     # Indent sequence
-    if args.four_space_indent:
-        INDENT = '    '
+    indent = '    ' if args.four_space_indent else INDENT
 
     # check vault
     vault_path = Path(args.vault_path)
@@ -647,8 +691,8 @@ if __name__ == "__main__":
         print(f"{output_path.resolve()} does not exist, creating it")
         output_path.mkdir(parents=True)
     else:
-        dir_contents = [c for c in output_path.iterdir()]
-        print(f"Destination {output_path.resolve()} contains {len(dir_contents)} items.")
+        num_items = len(os.listdir(output_path))
+        print(f"Destination {output_path.resolve()} contains {num_items} items.")
         print("Nothing will be deleted, but files might be overwritten.")
         if not args.yes and not ask_for_confirmation("Continue?", default='n'):
             print("Aborting.")
@@ -670,4 +714,5 @@ if __name__ == "__main__":
     vault2graph(vault_path, output_path,
                 remove_frontmatter=args.remove_frontmatter,
                 alias_title=args.alias_title, use_title=args.use_title,
-                remove_empty_lines=args.remove_empty_lines)
+                remove_empty_lines=args.remove_empty_lines, indent=indent,
+                link_assets=args.link_assets)